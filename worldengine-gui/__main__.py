@@ -2,19 +2,26 @@
 """
 PyQt5 GUI Interface for Worldengine
 """
-from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import QPoint, QRect, Qt, QTimer
+from PyQt5.QtGui import QColor, QImage, QPixmap
 from PyQt5.QtWidgets import QApplication, QDialog, QMainWindow, QAction, \
-    QFileDialog, QLabel, QWidget, QGridLayout, QPushButton, QLineEdit, QSpinBox
+    QFileDialog, QInputDialog, QLabel, QWidget, QGridLayout, QPushButton, \
+    QLineEdit, QMessageBox, QRubberBand, QSlider, QSpinBox, QToolTip
 import platec
+import os
 import random
 import sys
 import threading
 from worldengine.world import World, Step
 from worldengine.common import array_to_matrix
 from worldengine.generation import ErosionSimulation
-from view import draw_bw_elevation_on_screen, draw_land_on_screen, \
-    draw_plates_and_elevation_on_screen, draw_plates_on_screen
-from worldengine.plates import add_noise_to_elevation, center_land, \
+from view import VIEW_LAYERS, draw_view
+from bands import band_execution
+from timelapse import TimeLapseError, TimeLapseReader, TimeLapseWriter, \
+    to_grayscale
+from memory import MemoryBudget, format_bytes, layers_usage
+from inspector import LayerIndex, format_stats, format_values
+from finalization import add_noise_to_elevation, center_land, \
     initialize_ocean_and_thresholds, place_oceans_at_map_borders
 from worldengine.simulations.hydrology import WatermapSimulation
 from worldengine.simulations.irrigation import IrrigationSimulation
@@ -65,7 +72,12 @@ class GenerateDialog(QDialog):
         self.plates_num_value = self._spinner_box(2, 100, 10)
         grid.addWidget(self.plates_num_value, 4, 1, 1, 2)
 
-        buttons_row = 5
+        timelapse_label = QLabel('Time-lapse every N steps (0: off)')
+        grid.addWidget(timelapse_label, 5, 0, 1, 1)
+        self.timelapse_value = self._spinner_box(0, 1000, 0)
+        grid.addWidget(self.timelapse_value, 5, 1, 1, 2)
+
+        buttons_row = 6
         cancel = QPushButton('Cancel')
         generate = QPushButton('Generate')
         grid.addWidget(cancel, buttons_row, 1, 1, 1)
@@ -104,14 +116,18 @@ class GenerateDialog(QDialog):
     def name(self):
         return self.name_value.text()
 
+    def timelapse_every(self):
+        return self.timelapse_value.value()
+
 
 class GenerationProgressDialog(QDialog):
-    def __init__(self, parent, seed, name, width, height, num_plates):
+    def __init__(self, parent, seed, name, width, height, num_plates,
+                 recorder=None):
         QDialog.__init__(self, parent)
         self._init_ui()
         self.world = None
         self.gen_thread = GenerationThread(self, seed, name, width, height,
-                                           num_plates)
+                                           num_plates, recorder)
         self.gen_thread.start()
 
     def _init_ui(self):
@@ -148,32 +164,80 @@ class GenerationProgressDialog(QDialog):
 
 
 class GenerationThread(threading.Thread):
-    def __init__(self, ui, seed, name, width, height, num_plates):
+    def __init__(self, ui, seed, name, width, height, num_plates,
+                 recorder=None):
         threading.Thread.__init__(self)
         self.plates_generation = PlatesGeneration(seed, name, width, height,
                                                   num_plates=num_plates)
         self.ui = ui
+        self.recorder = recorder
+        self.recording_error = None
+
+    def _capture(self, n_steps):
+        try:
+            self.recorder.capture(n_steps,
+                                  self.plates_generation.heightmap())
+        except (IOError, OSError) as e:
+            # the recording is optional, the simulation goes on
+            self._stop_recording(e)
+
+    def _stop_recording(self, error=None):
+        recorder = self.recorder
+        self.recorder = None
+        try:
+            recorder.close()
+        except (IOError, OSError) as e:
+            error = error or e
+        if error is not None:
+            self.recording_error = str(error)
+            self.ui.set_status('Plate simulation: time-lapse not recorded '
+                               '(%s)' % self.recording_error)
+            try:
+                os.remove(recorder.filename)
+            except OSError:
+                pass
 
     def run(self):
         # FIXME it should be merged with world_gen
         finished = False
-        while not finished:
-            (finished, n_steps) = self.plates_generation.step()
-            self.ui.set_status('Plate simulation: step %i' % n_steps)
+        n_steps = 0
+        try:
+            while not finished:
+                if self.recorder and self.recorder.is_due(n_steps):
+                    self._capture(n_steps)
+                (finished, n_steps) = self.plates_generation.step()
+                self.ui.set_status('Plate simulation: step %i' % n_steps)
+            if self.recorder and self.recorder.last_step != n_steps:
+                # always keep the last step
+                self._capture(n_steps)
+        finally:
+            if self.recorder:
+                self._stop_recording()
         self.ui.set_status('Plate simulation: terminating plates simulation')
         w = self.plates_generation.world()
-        self.ui.set_status('Plate simulation: center land')
-        center_land(w)
-        self.ui.set_status('Plate simulation: adding noise')
-        add_noise_to_elevation(w, random.randint(0, 4096))
-        self.ui.set_status('Plate simulation: forcing oceans at borders')
-        place_oceans_at_map_borders(w)
-        self.ui.set_status('Plate simulation: finalization (can take a while)')
-        initialize_ocean_and_thresholds(w)
-        self.ui.set_status('Plate simulation: completed')
+        center_land(w, self._phase('center land'))
+        add_noise_to_elevation(w, random.randint(0, 4096),
+                               self._phase('adding noise'))
+        place_oceans_at_map_borders(w,
+                                    self._phase('forcing oceans at borders'))
+        initialize_ocean_and_thresholds(
+            w, progress=self._phase('finalization'))
+        if self.recording_error:
+            self.ui.set_status('Plate simulation: completed, time-lapse not '
+                               'recorded (%s)' % self.recording_error)
+        else:
+            self.ui.set_status('Plate simulation: completed')
         self.ui.world = w
         self.ui.on_finish()
 
+    def _phase(self, name):
+        """Return a progress function showing the status of a phase"""
+        def progress(fraction):
+            self.ui.set_status('Plate simulation: %s (%i%%)' % (
+                name, int(fraction * 100)))
+        progress(0.0)
+        return progress
+
 
 class PlatesGeneration(object):
     def __init__(self, seed, name, width, height,
@@ -201,6 +265,9 @@ class PlatesGeneration(object):
         else:
             return True, self.steps
 
+    def heightmap(self):
+        return platec.get_heightmap(self.p)
+
     def world(self):
         world = World(self.name, self.width, self.height, self.seed,
                       self.n_plates, self.ocean_level,
@@ -212,6 +279,60 @@ class PlatesGeneration(object):
         return world
 
 
+class MapLabel(QLabel):
+    """Label showing the map, reporting the cell under the cursor to
+    on_hover (at most once per screen refresh) and the region selected by
+    dragging to on_region
+    """
+
+    def __init__(self, on_hover, on_region):
+        QLabel.__init__(self)
+        self.on_hover = on_hover
+        self.on_region = on_region
+        # keep pixels and label coordinates the same
+        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        self.setMouseTracking(True)
+        self._pending = None
+        self._origin = None
+        self._rubber_band = QRubberBand(QRubberBand.Rectangle, self)
+        refresh_rate = QApplication.primaryScreen().refreshRate() or 60
+        self._timer = QTimer(self)
+        self._timer.setInterval(max(1, int(1000 / refresh_rate)))
+        self._timer.timeout.connect(self._on_tick)
+
+    def mouseMoveEvent(self, event):
+        self._pending = event.pos()
+        if not self._timer.isActive():
+            self._timer.start()
+        if self._origin is not None:
+            self._rubber_band.setGeometry(
+                QRect(self._origin, event.pos()).normalized())
+
+    def _on_tick(self):
+        if self._pending is None:
+            # the cursor did not move since the last refresh
+            self._timer.stop()
+            return
+        self.on_hover(self._pending.x(), self._pending.y())
+        self._pending = None
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self._origin = event.pos()
+            self._rubber_band.setGeometry(QRect(self._origin, self._origin))
+            self._rubber_band.show()
+
+    def mouseReleaseEvent(self, event):
+        if event.button() != Qt.LeftButton or self._origin is None:
+            return
+        rect = QRect(self._origin, event.pos()).normalized()
+        self._origin = None
+        self._rubber_band.hide()
+        if rect.width() > 1 and rect.height() > 1:
+            self.on_region(rect.left(), rect.top(), rect.right() + 1,
+                           rect.bottom() + 1)
+
+
 class MapCanvas(QImage):
     def __init__(self, label, width, height):
         QImage.__init__(self, width, height, QImage.Format_RGB32)
@@ -220,26 +341,90 @@ class MapCanvas(QImage):
 
     def draw_world(self, world, view):
         self.label.resize(world.width, world.height)
-        if view == 'bw':
-            draw_bw_elevation_on_screen(world, self)
-        elif view == 'plates':
-            draw_plates_on_screen(world, self)
-        elif view == 'plates and elevation':
-            draw_plates_and_elevation_on_screen(world, self)
-        elif view == 'land':
-            draw_land_on_screen(world, self)
-        elif view == 'precipitations':
-            PrecipitationsView().draw(world, self)
-        elif view == 'watermap':
-            WatermapView().draw(world, self)
-        else:
-            raise Exception("Unknown view %s" % view)
+        draw_view(world, view, self)
         self._update()
 
     def _update(self):
         self.label.setPixmap(QPixmap.fromImage(self))
 
 
+class TimeLapseDialog(QDialog):
+    def __init__(self, parent, reader):
+        QDialog.__init__(self, parent)
+        self.reader = reader
+        self.min_el, self.max_el = reader.elevation_range()
+        self._gray = None
+        self._init_ui()
+        self._on_frame(0)
+
+    def _init_ui(self):
+        self.resize(800, 600)
+        self.setWindowTitle('Plate simulation time-lapse')
+        grid = QGridLayout()
+
+        self.image = QLabel()
+        self.image.setAlignment(Qt.AlignCenter)
+        grid.addWidget(self.image, 0, 0, 1, 3)
+        grid.setRowStretch(0, 1)
+
+        self.slider = QSlider(Qt.Horizontal)
+        self.slider.setMinimum(0)
+        self.slider.setMaximum(len(self.reader) - 1)
+        self.slider.valueChanged.connect(self._on_frame)
+        grid.addWidget(self.slider, 1, 0, 1, 3)
+
+        self.play = QPushButton('Play')
+        self.play.clicked.connect(self._on_play)
+        grid.addWidget(self.play, 2, 0, 1, 1)
+
+        self.status = QLabel('')
+        grid.addWidget(self.status, 2, 1, 1, 1)
+
+        close = QPushButton('Close')
+        close.clicked.connect(self._on_close)
+        grid.addWidget(close, 2, 2, 1, 1)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(40)
+        self.timer.timeout.connect(self._on_tick)
+
+        self.setLayout(grid)
+
+    def _on_frame(self, i):
+        r = self.reader
+        # the image does not copy the data: keep a reference to it
+        self._gray = to_grayscale(r.frame(i), self.min_el, self.max_el)
+        image = QImage(self._gray, r.width, r.height, r.width,
+                       QImage.Format_Indexed8)
+        image.setColorTable([QColor(v, v, v).rgb() for v in range(256)])
+        pixmap = QPixmap.fromImage(image)
+        if r.width > 780 or r.height > 520:
+            pixmap = pixmap.scaled(780, 520, Qt.KeepAspectRatio)
+        self.image.setPixmap(pixmap)
+        self.status.setText('Step %i (frame %i of %i)' % (
+            r.step(i), i + 1, len(r)))
+
+    def _on_play(self):
+        if self.timer.isActive():
+            self.timer.stop()
+            self.play.setText('Play')
+        else:
+            if self.slider.value() == self.slider.maximum():
+                self.slider.setValue(0)
+            self.timer.start()
+            self.play.setText('Pause')
+
+    def _on_tick(self):
+        if self.slider.value() < self.slider.maximum():
+            self.slider.setValue(self.slider.value() + 1)
+        else:
+            self._on_play()
+
+    def _on_close(self):
+        self.timer.stop()
+        QDialog.accept(self)
+
+
 class OperationDialog(QDialog):
     def __init__(self, parent, world, operation):
         QDialog.__init__(self, parent)
@@ -293,9 +478,10 @@ class OperationThread(threading.Thread):
 
 
 class SimulationOp(object):
-    def __init__(self, title, simulation):
+    def __init__(self, title, simulation, parallel=False):
         self._title = title
         self.simulation = simulation
+        self.parallel = parallel
 
     def title(self):
         return self._title
@@ -308,28 +494,60 @@ class SimulationOp(object):
         """
         seed = random.randint(0, 65536)
         ui.set_status("%s: started (seed %i)" % (self.title(), seed))
-        self.simulation.execute(world, seed)
+        banded = None
+        if self.parallel:
+            banded = band_execution(self.simulation)
+        if banded is None:
+            self.simulation.execute(world, seed)
+        else:
+            def progress(done, total):
+                ui.set_status("%s: band %i of %i (seed %i)" % (
+                    self.title(), done, total, seed))
+            banded.execute(world, seed, progress=progress)
         ui.set_status("%s: done (seed %i)" % (self.title(), seed))
         ui.on_finish()
 
 
+MB = 1024 * 1024
+
+# Layers read or written by each simulation, restored to lists before
+# running it when a memory budget is set
+SIMULATION_LAYERS = {
+    PrecipitationSimulation: ['ocean'],
+    ErosionSimulation: ['elevation', 'ocean', 'precipitation'],
+    WatermapSimulation: ['elevation', 'ocean', 'precipitation'],
+    IrrigationSimulation: ['ocean', 'watermap'],
+    HumiditySimulation: ['ocean', 'precipitation', 'irrigation'],
+    TemperatureSimulation: ['elevation', 'ocean'],
+    PermeabilitySimulation: ['ocean'],
+    BiomeSimulation: ['ocean', 'temperature', 'humidity']
+}
+
+
 class WorldEngineGui(QMainWindow):
     def __init__(self):
         super(WorldEngineGui, self).__init__()
-        self._init_ui()
         self.world = None
         self.current_view = None
         self.canvas = None
+        self.budget = None
+        self.index = None
+        self._init_ui()
 
     def set_status(self, message):
         self.statusBar().showMessage(message)
 
+    def closeEvent(self, event):
+        if self.budget is not None:
+            self.budget.cleanup()
+        super(WorldEngineGui, self).closeEvent(event)
+
     def _init_ui(self):
         self.resize(800, 600)
         self.setWindowTitle('Worldengine - A world generator')
         self.set_status('No world selected: create or load a world')
         self._prepare_menu()
-        self.label = QLabel()
+        self.label = MapLabel(self._on_hover, self._on_region)
         self.canvas = MapCanvas(self.label, 0, 0)
 
         # dummy widget to contain the layout manager
@@ -344,13 +562,81 @@ class WorldEngineGui(QMainWindow):
         self.layout.setRowStretch(2, 1)
         # Add widgets
         self.layout.addWidget(self.label, 1, 1)
+
+        self.memory_label = QLabel()
+        self.statusBar().addPermanentWidget(self.memory_label)
+        self.memory_timer = QTimer(self)
+        self.memory_timer.timeout.connect(self._update_memory_readout)
+        self.memory_timer.start(1000)
         self.show()
 
+    def _update_memory_readout(self):
+        if self.world is None:
+            return
+        usage = layers_usage(self.world)
+        frames = [('canvas image', self.canvas.byteCount())]
+        pixmap = self.label.pixmap()
+        if pixmap is not None:
+            frames.append(('canvas pixmap', pixmap.width() * pixmap.height() *
+                           pixmap.depth() // 8))
+        if self.index is not None:
+            frames.append(('inspector index', self.index.nbytes))
+        resident = sum(size for _, size, in_memory in usage if in_memory)
+        resident += sum(size for _, size in frames)
+        spilled = sum(size for _, size, in_memory in usage if not in_memory)
+        text = 'Memory: %s' % format_bytes(resident)
+        if spilled > 0:
+            text += ' (%s on disk)' % format_bytes(spilled)
+        if self.budget is not None:
+            text += ' - budget %s' % format_bytes(self.budget.max_bytes)
+        self.memory_label.setText(text)
+        details = ['%s: %s%s' % (name, format_bytes(size),
+                                 '' if in_memory else ' (on disk)')
+                   for name, size, in_memory in usage]
+        details += ['%s: %s' % (name, format_bytes(size))
+                    for name, size in frames]
+        self.memory_label.setToolTip('\n'.join(details))
+
+    def _on_hover(self, x, y):
+        if self.index is None or not self.index.contains(x, y):
+            return
+        self.set_status('x: %i, y: %i | %s' % (
+            x, y, ' | '.join(format_values(self.index.at(x, y)))))
+
+    def _on_region(self, x0, y0, x1, y1):
+        if self.index is None:
+            return
+        stats = self.index.region_stats(x0, y0, x1, y1)
+        if not stats:
+            return
+        lines = ['Region %i, %i - %i, %i' % (x0, y0, x1 - 1, y1 - 1)]
+        lines += format_stats(stats)
+        QToolTip.showText(self.label.mapToGlobal(QPoint(x1, y1)),
+                          '\n'.join(lines), self.label)
+
+    def _compact_layers(self):
+        if self.budget is not None and self.world is not None:
+            self.budget.compact(self.world,
+                                VIEW_LAYERS.get(self.current_view, []))
+
+    def _build_index(self):
+        # release the previous index before building the new one
+        self.index = None
+        self.index = LayerIndex(self.world, self.budget)
+
+    def _restore_layers(self, names=None):
+        if self.budget is not None and self.world is not None:
+            self.budget.restore(self.world, names)
+
     def set_world(self, world):
+        if self.budget is not None and self.world is not None and \
+                self.world is not world:
+            self.budget.release(self.world)
         self.world = world
         self.canvas = MapCanvas(self.label, self.world.width,
                                 self.world.height)
         self._on_bw_view()
+        self._build_index()
 
         self.saveproto_action.setEnabled(world is not None)
         self.bw_view.setEnabled(world is not None)
@@ -394,6 +680,10 @@ class WorldEngineGui(QMainWindow):
         open_action = QAction('&Open', self)
         open_action.triggered.connect(self._on_open)
 
+        timelapse_action = QAction('Open &time-lapse', self)
+        timelapse_action.setStatusTip('Replay a recorded plate simulation')
+        timelapse_action.triggered.connect(self._on_open_timelapse)
+
         self.saveproto_action = QAction('&Save (protobuf)', self)
         self.saveproto_action.setEnabled(False)
         self.saveproto_action.setShortcut('Ctrl+S')
@@ -454,11 +744,32 @@ class WorldEngineGui(QMainWindow):
         self.biome_action.triggered.connect(self._on_biome)
         self.biome_action.setEnabled(False)
 
+        self.parallel_action = QAction('Run in parallel', self)
+        self.parallel_action.setStatusTip(
+            'Split the simulations in bands computed by several processes')
+        self.parallel_action.setCheckable(True)
+        self.parallel_action.setChecked(False)
+
+        self.memory_budget_action = QAction('Memory &budget...', self)
+        self.memory_budget_action.setStatusTip(
+            'Limit the memory used by the layers of the world')
+        self.memory_budget_action.triggered.connect(self._on_memory_budget)
+
+        self.float32_action = QAction('Store sea depth and permeability as '
+                                      'float32 (lossy)', self)
+        self.float32_action.setStatusTip(
+            'With a memory budget, halve the memory of the layers used by '
+            'no simulation; their saved values are rounded too')
+        self.float32_action.setCheckable(True)
+        self.float32_action.setChecked(False)
+        self.float32_action.triggered.connect(self._on_float32)
+
         menubar = self.menuBar()
 
         file_menu = menubar.addMenu('&File')
         file_menu.addAction(generate_action)
         file_menu.addAction(open_action)
+        file_menu.addAction(timelapse_action)
         file_menu.addAction(self.saveproto_action)
         file_menu.addAction(exit_action)
 
@@ -471,6 +782,8 @@ class WorldEngineGui(QMainWindow):
         simulations_menu.addAction(self.temperature_action)
         simulations_menu.addAction(self.permeability_action)
         simulations_menu.addAction(self.biome_action)
+        simulations_menu.addSeparator()
+        simulations_menu.addAction(self.parallel_action)
 
         view_menu = menubar.addMenu('&View')
         view_menu.addAction(self.bw_view)
@@ -480,29 +793,40 @@ class WorldEngineGui(QMainWindow):
         view_menu.addAction(self.precipitations_view)
         view_menu.addAction(self.watermap_view)
 
+        options_menu = menubar.addMenu('&Options')
+        options_menu.addAction(self.memory_budget_action)
+        options_menu.addAction(self.float32_action)
+
+    def _parallel(self):
+        return self.parallel_action.isChecked()
+
+    def _draw_current_view(self):
+        self._compact_layers()
+        self.canvas.draw_world(self.world, self.current_view)
+
     def _on_bw_view(self):
         self.current_view = 'bw'
-        self.canvas.draw_world(self.world, self.current_view)
+        self._draw_current_view()
 
     def _on_plates_view(self):
         self.current_view = 'plates'
-        self.canvas.draw_world(self.world, self.current_view)
+        self._draw_current_view()
 
     def _on_plates_and_elevation_view(self):
         self.current_view = 'plates and elevation'
-        self.canvas.draw_world(self.world, self.current_view)
+        self._draw_current_view()
 
     def _on_land_view(self):
         self.current_view = 'land'
-        self.canvas.draw_world(self.world, self.current_view)
+        self._draw_current_view()
 
     def _on_precipitations_view(self):
         self.current_view = 'precipitations'
-        self.canvas.draw_world(self.world, self.current_view)
+        self._draw_current_view()
 
     def _on_watermap_view(self):
         self.current_view = 'watermap'
-        self.canvas.draw_world(self.world, self.current_view)
+        self._draw_current_view()
 
     def _on_generate(self):
         dialog = GenerateDialog(self)
@@ -513,16 +837,43 @@ class WorldEngineGui(QMainWindow):
             height = dialog.height()
             num_plates = dialog.num_plates()
             name = str(dialog.name())
+            recorder = None
+            recording_error = None
+            if dialog.timelapse_every() > 0:
+                # no recording when the file is not chosen
+                filename, _ = QFileDialog.getSaveFileName(
+                    self, "Save time-lapse", '%s.timelapse' % name,
+                    "*.timelapse")
+                if filename:
+                    try:
+                        recorder = TimeLapseWriter(filename, width, height,
+                                                   dialog.timelapse_every())
+                    except (IOError, OSError) as e:
+                        recording_error = str(e)
             dialog2 = GenerationProgressDialog(self, seed, name, width, height,
-                                               num_plates)
+                                               num_plates, recorder)
             ok2 = dialog2.exec_()
             if ok2:
                 self.set_world(dialog2.world)
+            recording_error = recording_error or \
+                dialog2.gen_thread.recording_error
+            # the generation keeps running in background when cancelled
+            if recording_error:
+                self.set_status('Time-lapse not recorded: %s' %
+                                recording_error)
+            elif recorder and recorder.closed:
+                self.set_status('Time-lapse saved to %s' % recorder.filename)
+            elif recorder:
+                self.set_status('Time-lapse will be saved to %s when the '
+                                'plate simulation ends' % recorder.filename)
 
     def _on_save_protobuf(self):
         filename = QFileDialog.getSaveFileName(self, "Save world", "",
                                                      "*.world")
-        self.world.protobuf_to_file(filename)
+        if self.budget is not None:
+            self.budget.save(self.world, filename)
+        else:
+            self.world.protobuf_to_file(filename)
 
     def _on_open(self):
         filename = QFileDialog.getOpenFileName(self, "Open world", "",
@@ -530,80 +881,141 @@ class WorldEngineGui(QMainWindow):
         world = World.open_protobuf(filename)
         self.set_world(world)
 
+    def _on_open_timelapse(self):
+        filename, _ = QFileDialog.getOpenFileName(self, "Open time-lapse",
+                                                  "", "*.timelapse")
+        if not filename:
+            return
+        try:
+            reader = TimeLapseReader(filename)
+        except (TimeLapseError, IOError, OSError) as e:
+            QMessageBox.warning(self, "Open time-lapse", str(e))
+            return
+        dialog = TimeLapseDialog(self, reader)
+        dialog.exec_()
+        reader.close()
+
+    def _on_memory_budget(self):
+        current = 0
+        if self.budget is not None:
+            current = self.budget.max_bytes // MB
+        value, ok = QInputDialog.getInt(
+            self, 'Memory budget',
+            'Maximum memory used by the layers, in MB (0: no limit)',
+            current, 0, 1024 * 1024)
+        if not ok:
+            return
+        if value == 0:
+            self._restore_layers()
+            self.budget = None
+        elif self.budget is None:
+            self.budget = MemoryBudget(value * MB,
+                                       float32=self.float32_action.isChecked())
+        else:
+            self.budget.max_bytes = value * MB
+        self._compact_layers()
+        if self.world is not None:
+            self._build_index()
+
+    def _on_float32(self):
+        if self.budget is not None:
+            self.budget.float32 = self.float32_action.isChecked()
+            self._compact_layers()
+
     def _on_precipitations(self):
+        self._restore_layers(SIMULATION_LAYERS[PrecipitationSimulation])
         dialog = OperationDialog(self, self.world,
                                  SimulationOp("Simulating precipitations",
-                                              PrecipitationSimulation()))
+                                              PrecipitationSimulation(),
+                                              self._parallel()))
         ok = dialog.exec_()
         if ok:
             # just to refresh things to enable
             self.set_world(self.world)
 
     def _on_erosion(self):
+        self._restore_layers(SIMULATION_LAYERS[ErosionSimulation])
         dialog = OperationDialog(self, self.world,
                                  SimulationOp("Simulating erosion",
-                                              ErosionSimulation()))
+                                              ErosionSimulation(),
+                                              self._parallel()))
         ok = dialog.exec_()
         if ok:
             # just to refresh things to enable
             self.set_world(self.world)
 
     def _on_watermap(self):
+        self._restore_layers(SIMULATION_LAYERS[WatermapSimulation])
         dialog = OperationDialog(self, self.world,
                                  SimulationOp("Simulating water flow",
-                                              WatermapSimulation()))
+                                              WatermapSimulation(),
+                                              self._parallel()))
         ok = dialog.exec_()
         if ok:
             # just to refresh things to enable
             self.set_world(self.world)
 
     def _on_irrigation(self):
+        self._restore_layers(SIMULATION_LAYERS[IrrigationSimulation])
         dialog = OperationDialog(self, self.world,
                                  SimulationOp("Simulating irrigation",
-                                              IrrigationSimulation()))
+                                              IrrigationSimulation(),
+                                              self._parallel()))
         ok = dialog.exec_()
         if ok:
             # just to refresh things to enable
             self.set_world(self.world)
 
     def _on_humidity(self):
+        self._restore_layers(SIMULATION_LAYERS[HumiditySimulation])
         dialog = OperationDialog(self, self.world,
                                  SimulationOp("Simulating humidity",
-                                              HumiditySimulation()))
+                                              HumiditySimulation(),
+                                              self._parallel()))
         ok = dialog.exec_()
         if ok:
             # just to refresh things to enable
             self.set_world(self.world)
 
     def _on_temperature(self):
+        self._restore_layers(SIMULATION_LAYERS[TemperatureSimulation])
         dialog = OperationDialog(self, self.world,
                                  SimulationOp("Simulating temperature",
-                                              TemperatureSimulation()))
+                                              TemperatureSimulation(),
+                                              self._parallel()))
         ok = dialog.exec_()
         if ok:
             # just to refresh things to enable
             self.set_world(self.world)
 
     def _on_permeability(self):
+        self._restore_layers(SIMULATION_LAYERS[PermeabilitySimulation])
         dialog = OperationDialog(self, self.world,
                                  SimulationOp("Simulating permeability",
-                                              PermeabilitySimulation()))
+                                              PermeabilitySimulation(),
+                                              self._parallel()))
         ok = dialog.exec_()
         if ok:
             # just to refresh things to enable
             self.set_world(self.world)
 
     def _on_biome(self):
+        self._restore_layers(SIMULATION_LAYERS[BiomeSimulation])
         dialog = OperationDialog(self, self.world,
                                  SimulationOp("Simulating biome",
-                                              BiomeSimulation()))
+                                              BiomeSimulation(),
+                                              self._parallel()))
         ok = dialog.exec_()
         if ok:
             # just to refresh things to enable
             self.set_world(self.world)
 
 
-app = QApplication(sys.argv)
-lg = WorldEngineGui()
-assert lg
-sys.exit(app.exec_())
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        import tileserver
+        sys.exit(tileserver.main(sys.argv[2:]))
+    app = QApplication(sys.argv)
+    lg = WorldEngineGui()
+    assert lg
+    sys.exit(app.exec_())
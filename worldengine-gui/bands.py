@@ -0,0 +1,438 @@
+"""
+Band-parallel execution of the per-cell simulations.
+
+The world is split in bands of rows which are computed by a pool of
+processes. Layers are shared with the workers through shared memory, each
+worker copies the rows of its band (plus the halo rows it needs around it)
+and writes its results back in place. Thresholds and everything else
+requiring the whole world are computed afterwards on the stitched result,
+by the same worldengine functions used by the serial simulations, so the
+results are identical to a serial run.
+
+Only the simulations registered in BAND_EXECUTIONS can be split, all the
+others are executed on the whole world.
+
+The kernels are copies of the worldengine computations: run this module on
+a world to check that they still give the same results as the serial
+simulations,
+
+    python worldengine-gui/bands.py my.world
+"""
+import copy
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import random
+from worldengine.simulations.basic import find_threshold_f
+from worldengine.simulations.biome import BiomeSimulation
+from worldengine.simulations.humidity import HumiditySimulation
+from worldengine.simulations.permeability import PermeabilitySimulation
+from worldengine.simulations.temperature import TemperatureSimulation
+
+
+# shared layers of the worker processes, set by _init_worker
+_shared = {}
+
+
+def _init_worker(shared, width, height):
+    _shared['layers'] = shared
+    _shared['width'] = width
+    _shared['height'] = height
+
+
+def _run_band(task):
+    kernel, y0, y1, halo, params = task
+    width = _shared['width']
+    height = _shared['height']
+    layers = _shared['layers']
+    ya = max(0, y0 - halo)
+    yb = min(height, y1 + halo)
+    rows = {}
+    for name, array in layers.items():
+        flat = array[ya * width:yb * width]
+        rows[name] = [flat[y * width:(y + 1) * width]
+                      for y in range(yb - ya)]
+    results = kernel(rows, y0 - ya, y1 - ya, y0, width, height, params)
+    for name, band in results.items():
+        array = layers[name]
+        for i, row in enumerate(band):
+            y = y0 + i
+            array[y * width:(y + 1) * width] = row
+    return y1 - y0
+
+
+def _to_shared(matrix, typecode, width, height):
+    array = RawArray(typecode, width * height)
+    for y in range(height):
+        array[y * width:(y + 1) * width] = matrix[y]
+    return array
+
+
+def _from_shared(array, width, height):
+    return [array[y * width:(y + 1) * width] for y in range(height)]
+
+
+def split_bands(height, n_bands):
+    """Return the (first row, last row + 1) of each band"""
+    n_bands = max(1, min(n_bands, height))
+    bands = []
+    for i in range(n_bands):
+        y0 = height * i // n_bands
+        y1 = height * (i + 1) // n_bands
+        bands.append((y0, y1))
+    return bands
+
+
+def run_in_bands(width, height, inputs, outputs, kernel, params, halo=0,
+                 processes=None, progress=None):
+    """Execute kernel on bands of rows in a pool of processes.
+
+    :param inputs: a dict name -> (matrix, typecode) of the layers read
+    :param outputs: a dict name -> typecode of the layers written
+    :param kernel: a module level function receiving the rows of the band
+                   (plus halo rows), the index of the first and last + 1
+                   row of the band within them, the index of the first row
+                   in the world, the world dimensions and params. It returns
+                   a dict name -> rows of each output
+    :param progress: called with the number of bands done and the total
+    :return: a dict name -> matrix of each output
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    shared = {}
+    for name, (matrix, typecode) in inputs.items():
+        shared[name] = _to_shared(matrix, typecode, width, height)
+    for name, typecode in outputs.items():
+        shared[name] = RawArray(typecode, width * height)
+    # more bands than processes to even out the work between them
+    bands = split_bands(height, processes * 4)
+    tasks = [(kernel, y0, y1, halo, params) for y0, y1 in bands]
+    # never fork: the GUI process runs Qt and several threads
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('spawn')
+    else:
+        context = multiprocessing
+    pool = context.Pool(processes, initializer=_init_worker,
+                        initargs=(shared, width, height))
+    try:
+        for i, _ in enumerate(pool.imap_unordered(_run_band, tasks)):
+            if progress:
+                progress(i + 1, len(tasks))
+    finally:
+        pool.close()
+        pool.join()
+    return dict((name, _from_shared(shared[name], width, height))
+                for name in outputs)
+
+
+# -------
+# Kernels
+# -------
+#
+# They mirror the per-cell computations of the worldengine simulations, any
+# change to the arithmetic would make the results differ from a serial run.
+
+def _temperature_kernel(rows, r0, r1, y_offset, width, height, params):
+    from noise import snoise2
+
+    base, mountain_level = params
+    elevation = rows['elevation']
+    border = width / 4
+    octaves = 6
+    freq = 16.0 * octaves
+
+    temp = []
+    for r in range(r0, r1):
+        y = y_offset + r - r0
+        y_scaled = float(y) / height
+        latitude_factor = 1.0 - (abs(y_scaled - 0.5) * 2)
+        row = []
+        for x in range(0, width):
+            n = snoise2(x / freq, y / freq, octaves, base=base)
+
+            if x <= border:
+                n = (snoise2(x / freq, y / freq, octaves,
+                             base=base) * x / border) \
+                    + (snoise2((x + width) / freq, y / freq, octaves,
+                               base=base) * (border - x) / border)
+
+            t = (latitude_factor * 3 + n * 2) / 5.0
+            if elevation[r][x] > mountain_level:
+                if elevation[r][x] > (mountain_level + 29):
+                    altitude_factor = 0.033
+                else:
+                    altitude_factor = 1.00 - (
+                        float(elevation[r][x] - mountain_level) / 30)
+                t *= altitude_factor
+            row.append(t)
+        temp.append(row)
+    return {'temperature': temp}
+
+
+def _permeability_kernel(rows, r0, r1, y_offset, width, height, params):
+    from noise import snoise2
+
+    base = params
+    octaves = 6
+    freq = 64.0 * octaves
+
+    perm = []
+    for r in range(r0, r1):
+        y = y_offset + r - r0
+        perm.append([snoise2(x / freq, y / freq, octaves, base=base)
+                     for x in range(0, width)])
+    return {'permeability': perm}
+
+
+def _humidity_kernel(rows, r0, r1, y_offset, width, height, params):
+    precipitation = rows['precipitation']
+    irrigation = rows['irrigation']
+    humidity = []
+    for r in range(r0, r1):
+        humidity.append([precipitation[r][x] + irrigation[r][x]
+                         for x in range(width)])
+    return {'humidity': humidity}
+
+
+# For each temperature range (from polar to tropical) the biomes for each
+# humidity range (from superarid on), the last one being used for all the
+# remaining humidity ranges
+_BIOME_TABLE = [
+    ['polar desert', 'ice'],
+    ['subpolar dry tundra', 'subpolar moist tundra', 'subpolar wet tundra',
+     'subpolar rain tundra'],
+    ['boreal desert', 'boreal dry scrub', 'boreal moist forest',
+     'boreal wet forest', 'boreal rain forest'],
+    ['cool temperate desert', 'cool temperate desert scrub',
+     'cool temperate steppe', 'cool temperate moist forest',
+     'cool temperate wet forest', 'cool temperate rain forest'],
+    ['warm temperate desert', 'warm temperate desert scrub',
+     'warm temperate thorn scrub', 'warm temperate dry forest',
+     'warm temperate moist forest', 'warm temperate wet forest',
+     'warm temperate rain forest'],
+    ['subtropical desert', 'subtropical desert scrub',
+     'subtropical thorn woodland', 'subtropical dry forest',
+     'subtropical moist forest', 'subtropical wet forest',
+     'subtropical rain forest'],
+    ['tropical desert', 'tropical desert scrub', 'tropical thorn woodland',
+     'tropical very dry forest', 'tropical dry forest',
+     'tropical moist forest', 'tropical wet forest', 'tropical rain forest']
+]
+
+BIOME_NAMES = ['ocean', 'bare rock'] + \
+    [name for names in _BIOME_TABLE for name in names]
+
+_HUMIDITY_QUANTILES = ['87', '75', '62', '50', '37', '25', '12']
+
+
+def _in_range(v, th_min, th_max):
+    # same comparisons of the World.is_temperature_* and is_humidity_*
+    if th_min is None:
+        return v < th_max
+    if th_max is None:
+        return v >= th_min
+    return th_max > v >= th_min
+
+
+def _biome_kernel(rows, r0, r1, y_offset, width, height, params):
+    temperature_ranges, humidity_ranges = params
+    temperature = rows['temperature']
+    humidity = rows['humidity']
+    ocean = rows['ocean']
+    codes = dict((name, i) for i, name in enumerate(BIOME_NAMES))
+    table = [[codes[name] for name in names] for names in _BIOME_TABLE]
+
+    biome = []
+    for r in range(r0, r1):
+        row = []
+        for x in range(width):
+            if ocean[r][x]:
+                row.append(codes['ocean'])
+                continue
+            code = codes['bare rock']
+            t = temperature[r][x]
+            h = humidity[r][x]
+            for t_range, biomes in zip(temperature_ranges, table):
+                if _in_range(t, *t_range):
+                    code = biomes[-1]
+                    for h_range, b in zip(humidity_ranges, biomes[:-1]):
+                        if _in_range(h, *h_range):
+                            code = b
+                            break
+                    break
+            row.append(code)
+        biome.append(row)
+    return {'biome': biome}
+
+
+def _ranges(thresholds):
+    ranges = []
+    th_min = None
+    for th_max in thresholds:
+        ranges.append((th_min, th_max))
+        th_min = th_max
+    ranges.append((th_min, None))
+    return ranges
+
+
+# -----------------------
+# Simulations executions
+# -----------------------
+
+class TemperatureBands(object):
+    layer = 'temperature'
+
+    def execute(self, world, seed, processes=None, progress=None):
+        e = world.elevation['data']
+        ml = world.start_mountain_th()
+        ocean = world.ocean
+
+        random.seed(seed * 7)
+        base = random.randint(0, 4096)
+        t = run_in_bands(world.width, world.height,
+                         {'elevation': (e, 'd')}, {'temperature': 'd'},
+                         _temperature_kernel, (base, ml),
+                         processes=processes,
+                         progress=progress)['temperature']
+        t_th = [
+            ('polar', find_threshold_f(t, 0.90, ocean)),
+            ('alpine', find_threshold_f(t, 0.76, ocean)),
+            ('boreal', find_threshold_f(t, 0.59, ocean)),
+            ('cool', find_threshold_f(t, 0.38, ocean)),
+            ('warm', find_threshold_f(t, 0.26, ocean)),
+            ('subtropical', find_threshold_f(t, 0.14, ocean)),
+            ('tropical', None)
+        ]
+        world.set_temperature(t, t_th)
+
+
+class PermeabilityBands(object):
+    layer = 'permeability'
+
+    def execute(self, world, seed, processes=None, progress=None):
+        random.seed(seed * 37)
+        base = random.randint(0, 4096)
+        perm = run_in_bands(world.width, world.height, {},
+                            {'permeability': 'd'}, _permeability_kernel,
+                            base, processes=processes,
+                            progress=progress)['permeability']
+        perm_th = [
+            ('low', find_threshold_f(perm, 0.75, world.ocean)),
+            ('med', find_threshold_f(perm, 0.25, world.ocean)),
+            ('hig', None)
+        ]
+        world.set_permeability(perm, perm_th)
+
+
+class HumidityBands(object):
+    layer = 'humidity'
+
+    def execute(self, world, seed, processes=None, progress=None):
+        assert seed
+        data = run_in_bands(world.width, world.height,
+                            {'precipitation': (world.precipitation['data'],
+                                               'd'),
+                             'irrigation': (world.irrigation, 'd')},
+                            {'humidity': 'd'}, _humidity_kernel, None,
+                            processes=processes,
+                            progress=progress)['humidity']
+        humidity = dict()
+        humidity['data'] = data
+        humidity['quantiles'] = {}
+        for q, perc in [('12', 0.02), ('25', 0.09), ('37', 0.26),
+                        ('50', 0.50), ('62', 0.74), ('75', 0.91),
+                        ('87', 0.98)]:
+            humidity['quantiles'][q] = find_threshold_f(data, perc,
+                                                        world.ocean)
+        world.humidity = humidity
+
+
+class BiomeBands(object):
+    layer = 'biome'
+
+    def execute(self, world, seed, processes=None, progress=None):
+        assert seed
+        temperature_ranges = _ranges(
+            [th for _, th in world.temperature['thresholds'][:-1]])
+        humidity_ranges = _ranges(
+            [world.humidity['quantiles'][q] for q in _HUMIDITY_QUANTILES])
+        codes = run_in_bands(world.width, world.height,
+                             {'temperature': (world.temperature['data'], 'd'),
+                              'humidity': (world.humidity['data'], 'd'),
+                              'ocean': (world.ocean, 'b')},
+                             {'biome': 'B'}, _biome_kernel,
+                             (temperature_ranges, humidity_ranges),
+                             processes=processes,
+                             progress=progress)['biome']
+        world.set_biome([[BIOME_NAMES[c] for c in row] for row in codes])
+
+
+BAND_EXECUTIONS = {
+    TemperatureSimulation: TemperatureBands,
+    PermeabilitySimulation: PermeabilityBands,
+    HumiditySimulation: HumidityBands,
+    BiomeSimulation: BiomeBands
+}
+
+
+def band_execution(simulation):
+    """Return the band execution of the simulation or None when it cannot
+    be split in bands
+    """
+    execution = BAND_EXECUTIONS.get(type(simulation))
+    if execution is None:
+        return None
+    return execution()
+
+
+def compare_with_serial(world, seed, processes=None):
+    """Run every band execution and its serial simulation on copies of
+    world, without the layer they produce. Return a list of (simulation
+    name, identical results), skipping the simulations not applicable to
+    world"""
+    results = []
+    for simulation_class in [TemperatureSimulation, PermeabilitySimulation,
+                             HumiditySimulation, BiomeSimulation]:
+        simulation = simulation_class()
+        banded = band_execution(simulation)
+        serial_world = copy.deepcopy(world)
+        if hasattr(serial_world, banded.layer):
+            delattr(serial_world, banded.layer)
+        if not simulation.is_applicable(serial_world):
+            continue
+        banded_world = copy.deepcopy(serial_world)
+        random.seed(seed)
+        simulation.execute(serial_world, seed)
+        random.seed(seed)
+        banded.execute(banded_world, seed, processes=processes)
+        identical = getattr(serial_world, banded.layer) == \
+            getattr(banded_world, banded.layer)
+        results.append((simulation_class.__name__, identical))
+    return results
+
+
+def main(argv=None):
+    import argparse
+    from worldengine.world import World
+
+    parser = argparse.ArgumentParser(
+        description='Check that the band executions give the same results '
+                    'as the serial simulations')
+    parser.add_argument('world', help='a .world file, the simulations '
+                                      'are checked if their inputs are '
+                                      'present')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    world = World.open_protobuf(args.world)
+    failed = False
+    for name, identical in compare_with_serial(world, args.seed,
+                                               args.processes):
+        print("%s: %s" % (name, 'identical' if identical else 'DIFFERENT'))
+        failed = failed or not identical
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
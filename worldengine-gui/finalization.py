@@ -0,0 +1,301 @@
+"""
+Array based versions of the steps run by worldengine after the plates
+simulation.
+
+They produce the same values as the functions of worldengine.generation,
+performing the same floating point operations in the same order, but on
+whole rows or whole maps at once. Each of them accepts a progress function
+called with the fraction of the work done.
+
+Run this module to check that they still give the same results as the
+worldengine functions on the reference worlds,
+
+    python worldengine-gui/finalization.py
+"""
+import copy
+import random
+import numpy
+from noise import snoise2
+
+
+def _report(progress, fraction):
+    if progress:
+        progress(fraction)
+
+
+def center_land(world, progress=None):
+    """Translate the map horizontally and vertically to put as much ocean as
+       possible at the borders. It operates on elevation and plates map"""
+    e = numpy.array(world.elevation['data'], dtype=numpy.float64)
+    # cumsum adds the values one after the other, as the original loops
+    y_with_min_sum = int(numpy.argmin(numpy.cumsum(e, axis=1)[:, -1]))
+    x_with_min_sum = int(numpy.argmin(numpy.cumsum(e, axis=0)[-1, :]))
+    _report(progress, 0.5)
+
+    e = numpy.roll(numpy.roll(e, -y_with_min_sum, axis=0),
+                   -x_with_min_sum, axis=1)
+    plates = world.plates[y_with_min_sum:] + world.plates[:y_with_min_sum]
+    world.elevation['data'] = e.tolist()
+    world.plates = [row[x_with_min_sum:] + row[:x_with_min_sum]
+                    for row in plates]
+    _report(progress, 1.0)
+
+
+def add_noise_to_elevation(world, seed, progress=None):
+    octaves = 6
+    freq = 16.0 * octaves
+    e = numpy.array(world.elevation['data'], dtype=numpy.float64)
+    for y in range(world.height):
+        e[y] += [snoise2(x / freq * 2, y / freq * 2, octaves, base=seed)
+                 for x in range(world.width)]
+        if y % 64 == 0:
+            _report(progress, float(y) / world.height)
+    world.elevation['data'] = e.tolist()
+    _report(progress, 1.0)
+
+
+def place_oceans_at_map_borders(world, progress=None):
+    """
+    Lower the elevation near the border of the map
+    """
+    ocean_border = int(min(30, max(world.width / 5, world.height / 5)))
+    e = numpy.array(world.elevation['data'], dtype=numpy.float64)
+    h = world.height
+    w = world.width
+    for i in range(ocean_border):
+        e[i] = (e[i] * i) / ocean_border
+        e[h - i - 1] = (e[h - i - 1] * i) / ocean_border
+    for i in range(ocean_border):
+        e[:, i] = (e[:, i] * i) / ocean_border
+        e[:, w - i - 1] = (e[:, w - i - 1] * i) / ocean_border
+    world.elevation['data'] = e.tolist()
+    _report(progress, 1.0)
+
+
+def fill_ocean(elevation, sea_level, progress=None):
+    """Return the cells at or below sea_level connected (also diagonally)
+    to the borders of the map.
+
+    Cells are grouped in horizontal runs below sea level, the runs reached
+    from the run above or below are then marked sweeping the rows down and
+    up until nothing changes.
+    """
+    height, width = elevation.shape
+    below = elevation <= sea_level
+    starts = below.copy()
+    starts[:, 1:] &= ~below[:, :-1]
+    run_id = numpy.cumsum(starts.ravel()).reshape(height, width)
+    run_id[~below] = 0
+    filled = numpy.zeros(run_id.max() + 1, dtype=numpy.bool_)
+    filled[run_id[0]] = True
+    filled[run_id[-1]] = True
+    filled[run_id[:, 0]] = True
+    filled[run_id[:, -1]] = True
+    filled[0] = False
+
+    def spread(y, from_y):
+        reached = filled[run_id[from_y]]
+        around = reached.copy()
+        around[1:] |= reached[:-1]
+        around[:-1] |= reached[1:]
+        runs = run_id[y][around & below[y]]
+        runs = runs[~filled[runs]]
+        if runs.size == 0:
+            return False
+        filled[runs] = True
+        return True
+
+    sweeps = 0
+    changed = True
+    while changed:
+        changed = False
+        for y in range(1, height):
+            changed = spread(y, y - 1) or changed
+        for y in range(height - 2, -1, -1):
+            changed = spread(y, y + 1) or changed
+        sweeps += 1
+        # the number of sweeps is not known in advance
+        _report(progress, 1.0 - 0.5 ** sweeps)
+    return filled[run_id]
+
+
+def find_thresholds(values, percentages):
+    """Return the threshold found by find_threshold_f for each of the land
+    percentages, counting the values above a threshold on a single sorted
+    copy of them."""
+    values = numpy.sort(numpy.asarray(values, dtype=numpy.float64).ravel())
+    all_land = len(values)
+
+    def count(e):
+        return all_land - int(numpy.searchsorted(values, e, side='right'))
+
+    thresholds = []
+    for land_perc in percentages:
+        desired = all_land * land_perc
+        a, b = -1000.0, 1000.0
+        while True:
+            if a == b:
+                break
+            if abs(b - a) < 0.005:
+                dista = abs(desired - count(a))
+                distb = abs(desired - count(b))
+                if not dista < distb:
+                    a = b
+                break
+            m = (a + b) / 2.0
+            if desired < count(m):
+                a = m
+            else:
+                b = m
+        thresholds.append(a)
+    return thresholds
+
+
+def _window_sums(values, radius):
+    """Return the sum of the values in the square around each cell, clipped
+    at the borders of the map"""
+    height, width = values.shape
+    integral = numpy.zeros((height + 1, width + 1), dtype=numpy.int64)
+    integral[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    ys = numpy.arange(height)
+    xs = numpy.arange(width)
+    y0 = numpy.clip(ys - radius, 0, height)
+    y1 = numpy.clip(ys + radius + 1, 0, height)
+    x0 = numpy.clip(xs - radius, 0, width)
+    x1 = numpy.clip(xs + radius + 1, 0, width)
+    return integral[numpy.ix_(y1, x1)] - integral[numpy.ix_(y0, x1)] - \
+        integral[numpy.ix_(y1, x0)] + integral[numpy.ix_(y0, x0)]
+
+
+def sea_depth(elevation, ocean, sea_level, progress=None):
+    steps = 15.0
+    land = (~ocean).astype(numpy.int64)
+    depth = sea_level - elevation
+    done = numpy.zeros(ocean.shape, dtype=numpy.bool_)
+    for radius, factor in [(1, 0), (2, 0.3), (3, 0.5), (4, 0.7), (5, 0.9)]:
+        # land tiles around, the cell itself excluded
+        near_land = (_window_sums(land, radius) - land) > 0
+        cells = near_land & ~done
+        if factor == 0:
+            depth[cells] = 0
+        else:
+            depth[cells] *= factor
+        done |= near_land
+        _report(progress, radius / steps)
+
+    # anti_alias: the cell of the original map counts twice, plus the 3x3
+    # square around it (wrapping) of the current one
+    original = depth
+    for i in range(10):
+        tot = original * 2
+        for dy in range(-1, +2):
+            rows = numpy.roll(depth, -dy, axis=0)
+            for dx in range(-1, +2):
+                tot = tot + numpy.roll(rows, -dx, axis=1)
+        depth = tot / 11
+        _report(progress, (6 + i) / steps)
+
+    min_depth = depth.min()
+    max_depth = depth.max()
+    return 0.0 + ((1.0 - 0.0) * ((depth - min_depth) /
+                                 (max_depth - min_depth)))
+
+
+def initialize_ocean_and_thresholds(world, ocean_level=1.0, progress=None):
+    """
+    Calculate the ocean, the sea depth and the elevation thresholds
+    :param world: a world having elevation but not thresholds
+    :param ocean_level: the elevation representing the ocean level
+    :return: nothing, the world will be changed
+    """
+    e = world.elevation['data']
+    elevation = numpy.array(e, dtype=numpy.float64)
+    ocean = fill_ocean(elevation, ocean_level,
+                       lambda f: _report(progress, f * 0.2))
+    hl, ml = find_thresholds(elevation, [0.10, 0.03])
+    _report(progress, 0.25)
+    e_th = [('sea', ocean_level),
+            ('plain', hl),
+            ('hill', ml),
+            ('mountain', None)]
+    world.set_ocean(ocean.tolist())
+    world.set_elevation(e, e_th)
+    world.sea_depth = sea_depth(
+        elevation, ocean, ocean_level,
+        lambda f: _report(progress, 0.25 + f * 0.75)).tolist()
+
+
+# (seed, width, height) of the worlds used to compare the results with the
+# worldengine functions
+REFERENCE_WORLDS = [
+    (1, 256, 256),
+    (42, 300, 200),
+    (1234, 200, 333),
+    (65000, 512, 512)
+]
+
+
+def compare_with_generation(seed, width, height, num_plates=10):
+    """Run the plates simulation, then the worldengine.generation steps and
+    their array versions on copies of the resulting world. Return a list of
+    (layer, identical results)"""
+    from worldengine import generation
+    from worldengine.common import array_to_matrix
+    from worldengine.plates import generate_plates_simulation
+    from worldengine.world import World, Step
+
+    heightmap, platesmap = generate_plates_simulation(
+        seed, width, height, num_plates=num_plates, verbose=False)
+    world = World('check', width, height, seed, num_plates, 1.0,
+                  Step.full())
+    world.set_elevation(array_to_matrix(heightmap, width, height), None)
+    world.set_plates(array_to_matrix(platesmap, width, height))
+    noise_seed = random.Random(seed).randint(0, 4096)
+
+    expected = copy.deepcopy(world)
+    generation.center_land(expected)
+    generation.add_noise_to_elevation(expected, noise_seed)
+    generation.place_oceans_at_map_borders(expected)
+    generation.initialize_ocean_and_thresholds(expected)
+
+    center_land(world)
+    add_noise_to_elevation(world, noise_seed)
+    place_oceans_at_map_borders(world)
+    initialize_ocean_and_thresholds(world)
+
+    results = []
+    for layer, get in [('elevation', lambda w: w.elevation['data']),
+                       ('plates', lambda w: w.plates),
+                       ('ocean', lambda w: w.ocean),
+                       ('sea_depth', lambda w: w.sea_depth)]:
+        identical = numpy.array_equal(numpy.asarray(get(world)),
+                                      numpy.asarray(get(expected)))
+        results.append((layer, identical))
+    results.append(('thresholds', world.elevation['thresholds'] ==
+                    expected.elevation['thresholds']))
+    return results
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Check that the array versions of the generation steps '
+                    'give the same results as the worldengine functions')
+    parser.add_argument('--num-plates', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for seed, width, height in REFERENCE_WORLDS:
+        results = compare_with_generation(seed, width, height,
+                                          args.num_plates)
+        print("seed %i, %ix%i: %s" % (seed, width, height, ', '.join(
+            '%s %s' % (layer, 'identical' if identical else 'DIFFERENT')
+            for layer, identical in results)))
+        failed = failed or not all(identical for _, identical in results)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""
+Index of the values of all the layers of a world, cell by cell.
+
+The layers are interleaved in a single structured array so that all the
+values under the cursor are read with a single lookup, and statistics on a
+region are computed on a slice of it.
+
+With a memory budget the layers are already compact arrays, possibly spilled
+to disk: they are read in place instead of being copied in the index.
+"""
+import numpy
+from memory import get_layer
+
+
+# field, layer and type of the values in the index
+_FIELDS = [
+    ('elevation', 'elevation', numpy.float64),
+    ('plate', 'plates', numpy.uint16),
+    ('ocean', 'ocean', numpy.bool_),
+    ('sea depth', 'sea_depth', numpy.float64),
+    ('precipitation', 'precipitation', numpy.float64),
+    ('irrigation', 'irrigation', numpy.float64),
+    ('watermap', 'watermap', numpy.float64),
+    ('humidity', 'humidity', numpy.float64),
+    ('temperature', 'temperature', numpy.float64),
+    ('permeability', 'permeability', numpy.float64),
+    ('biome', 'biome', numpy.uint8)
+]
+
+
+class LayerIndex(object):
+    """Values of the layers present in world.
+
+    :param budget: the memory budget of world, if any: its layers are read
+                   in place
+    """
+
+    def __init__(self, world, budget=None):
+        self.width = world.width
+        self.height = world.height
+        self.biome_names = None
+        self._world = world
+        self._budget = budget
+        fields = []
+        self._layers = []
+        for field, layer, dtype in _FIELDS:
+            data = get_layer(world, layer)
+            if data is None:
+                continue
+            fields.append((field, dtype))
+            self._layers.append((field, layer))
+        self.fields = [f for f, _ in fields]
+        self.index = None
+        if budget is not None:
+            return
+        self.index = numpy.zeros((self.height, self.width), dtype=fields)
+        for field, layer in self._layers:
+            data = get_layer(world, layer)
+            if field == 'biome':
+                data = self._biome_codes(data)
+            self.index[field] = numpy.asarray(data)
+
+    def _biome_codes(self, biome):
+        codes = {}
+        array = numpy.empty((self.height, self.width), dtype=numpy.uint8)
+        for y, row in enumerate(biome):
+            array[y] = [codes.setdefault(b, len(codes)) for b in row]
+        self.biome_names = sorted(codes, key=codes.get)
+        return array
+
+    def _biome_name(self, v):
+        if not isinstance(v, (int, numpy.integer)):
+            # a biome layer restored to names
+            return v
+        if self.index is None:
+            return self._budget.biome_names[v]
+        return self.biome_names[v]
+
+    @property
+    def nbytes(self):
+        if self.index is None:
+            return 0
+        return self.index.nbytes
+
+    def contains(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def at(self, x, y):
+        """Return a list of (field, value) of the cell"""
+        values = []
+        if self.index is None:
+            for field, layer in self._layers:
+                values.append((field, get_layer(self._world, layer)[y][x]))
+        else:
+            record = self.index[y, x]
+            values = [(field, record[field]) for field in self.fields]
+        return [(field, self._biome_name(v) if field == 'biome' else v)
+                for field, v in values]
+
+    def _region(self, field, layer, y0, y1, x0, x1):
+        if self.index is None:
+            data = get_layer(self._world, layer)[y0:y1]
+            return numpy.asarray(data)[:, x0:x1]
+        return self.index[field][y0:y1, x0:x1]
+
+    def region_stats(self, x0, y0, x1, y1):
+        """Return a list of (field, statistics) of the cells in the region.
+
+        Statistics are (min, mean, max) for numeric fields, the fraction of
+        cells for ocean and the most common biome for biome.
+        """
+        y0, y1 = max(0, y0), min(self.height, y1)
+        x0, x1 = max(0, x0), min(self.width, x1)
+        if y0 >= y1 or x0 >= x1:
+            return []
+        stats = []
+        for field, layer in self._layers:
+            values = self._region(field, layer, y0, y1, x0, x1)
+            if field == 'ocean':
+                stats.append((field, values.mean()))
+            elif field == 'biome':
+                biomes, counts = numpy.unique(values, return_counts=True)
+                stats.append((field,
+                              self._biome_name(biomes[counts.argmax()])))
+            else:
+                stats.append((field, (values.min(), values.mean(),
+                                      values.max())))
+        return stats
+
+
+def format_values(values):
+    parts = []
+    for field, v in values:
+        if field == 'ocean':
+            v = 'yes' if v else 'no'
+        elif isinstance(v, (float, numpy.floating)):
+            v = '%.6f' % v
+        parts.append('%s: %s' % (field, v))
+    return parts
+
+
+def format_stats(stats):
+    lines = []
+    for field, v in stats:
+        if field == 'ocean':
+            v = '%.1f%%' % (v * 100)
+        elif field == 'biome':
+            v = 'mostly %s' % v
+        else:
+            v = 'min %.4f, mean %.4f, max %.4f' % v
+        lines.append('%s: %s' % (field, v))
+    return lines
@@ -0,0 +1,276 @@
+"""
+Memory budget for the layers of large worlds.
+
+Worldengine keeps every layer as a list of lists of Python objects, which
+takes several times the memory of the values themselves. When a budget is
+set, layers are converted to numpy arrays of the smallest type holding their
+values exactly and, when the resident layers exceed the budget, the layers
+not needed by the current view are spilled to memory mapped files.
+
+Optionally the layers used by no simulation (FLOAT32_LAYERS) are stored as
+float32: this is lossy, their rounded values are the ones saved afterwards.
+
+The views read layers with the usual [y][x] indexing, which works on arrays
+too, while the worldengine simulations expect lists: the layers used by a
+simulation have to be restored before running it.
+"""
+import atexit
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import numpy
+
+
+# Layers which can be stored as float32: no simulation uses them as input
+FLOAT32_LAYERS = ('sea_depth', 'permeability')
+
+# Layers kept in a dict under the 'data' key
+_DICT_LAYERS = ('elevation', 'precipitation', 'temperature', 'humidity',
+                'permeability', 'watermap')
+
+LAYERS = ('elevation', 'plates', 'ocean', 'sea_depth', 'precipitation',
+          'irrigation', 'watermap', 'humidity', 'temperature', 'permeability',
+          'biome')
+
+
+def get_layer(world, name):
+    if not hasattr(world, name):
+        return None
+    if name in _DICT_LAYERS:
+        return getattr(world, name)['data']
+    return getattr(world, name)
+
+
+def set_layer(world, name, data):
+    if name in _DICT_LAYERS:
+        getattr(world, name)['data'] = data
+    else:
+        setattr(world, name, data)
+
+
+def layer_bytes(data):
+    """Return the estimated memory used by a layer and whether it is
+    resident (False for memory mapped arrays)"""
+    if isinstance(data, numpy.memmap):
+        return data.nbytes, False
+    if isinstance(data, numpy.ndarray):
+        return data.nbytes, True
+    size = sys.getsizeof(data)
+    for row in data:
+        size += sys.getsizeof(row)
+    # bools, small integers and biome names are shared objects while every
+    # float is a separate one
+    if len(data) > 0 and len(data[0]) > 0 and isinstance(data[0][0], float):
+        size += sys.getsizeof(data[0][0]) * len(data) * len(data[0])
+    return size, True
+
+
+def layers_usage(world):
+    """Return a list of (layer, bytes, resident) of the layers of world"""
+    usage = []
+    for name in LAYERS:
+        data = get_layer(world, name)
+        if data is not None:
+            size, resident = layer_bytes(data)
+            usage.append((name, size, resident))
+    return usage
+
+
+def format_bytes(size):
+    if size >= 1024 * 1024 * 1024:
+        return '%.1f GB' % (size / (1024.0 * 1024 * 1024))
+    if size >= 1024 * 1024:
+        return '%.1f MB' % (size / (1024.0 * 1024))
+    return '%.0f KB' % (size / 1024.0)
+
+
+class MemoryBudget(object):
+    """Keep the resident layers of a world within max_bytes.
+
+    :param float32: store FLOAT32_LAYERS as float32, losing precision also
+                    in the saved worlds
+    """
+
+    def __init__(self, max_bytes, directory=None, float32=False):
+        self.max_bytes = max_bytes
+        self.float32 = float32
+        self._directory = directory
+        self._spill_ids = itertools.count()
+        self.biome_names = None
+
+    def _spill_path(self, name):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='worldengine-gui-')
+            # also when cleanup is never called
+            atexit.register(shutil.rmtree, self._directory, True)
+        # never reuse the file of a layer, it can still be mapped
+        return os.path.join(self._directory, '%s-%i.dat' % (
+            name, next(self._spill_ids)))
+
+    def _dtype(self, name, data):
+        """Return the type of the compacted layer data"""
+        if name == 'biome':
+            return numpy.uint8
+        if name == 'ocean':
+            return numpy.bool_
+        if name == 'plates':
+            if isinstance(data, numpy.ndarray):
+                return data.dtype
+            if max(max(row) for row in data) < 256:
+                return numpy.uint8
+            return numpy.uint16
+        if self.float32 and name in FLOAT32_LAYERS:
+            return numpy.float32
+        return numpy.float64
+
+    def _compact_nbytes(self, name, data):
+        itemsize = numpy.dtype(self._dtype(name, data)).itemsize
+        return len(data) * len(data[0]) * itemsize
+
+    def _fill(self, name, data, array):
+        """Copy the rows of the list layer data into array"""
+        if name == 'biome':
+            codes = {}
+            for y, row in enumerate(data):
+                array[y] = [codes.setdefault(b, len(codes)) for b in row]
+            self.biome_names = sorted(codes, key=codes.get)
+        else:
+            for y, row in enumerate(data):
+                array[y] = row
+
+    def _spill(self, name, data):
+        """Write data, a list layer or an array, to a memory mapped
+        file"""
+        dtype = self._dtype(name, data)
+        shape = (len(data), len(data[0]))
+        path = self._spill_path(name)
+        mapped = numpy.memmap(path, dtype=dtype, mode='w+', shape=shape)
+        if isinstance(data, numpy.ndarray):
+            mapped[:] = data
+        else:
+            self._fill(name, data, mapped)
+        mapped.flush()
+        del mapped
+        return numpy.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+    def _load(self, name, data):
+        """Return data, a list layer or a spilled one, as an array in
+        memory"""
+        if isinstance(data, numpy.ndarray):
+            return numpy.array(data, dtype=self._dtype(name, data))
+        array = numpy.empty((len(data), len(data[0])),
+                            dtype=self._dtype(name, data))
+        self._fill(name, data, array)
+        return array
+
+    @staticmethod
+    def _remove_spilled(data):
+        if isinstance(data, numpy.memmap):
+            try:
+                os.remove(data.filename)
+            except OSError:
+                pass
+
+    def compact(self, world, active=()):
+        """Convert the layers of world to arrays and spill to disk the
+        inactive ones exceeding the budget. The active layers are always
+        kept in memory.
+
+        Layers are converted one at a time, a layer to be spilled is
+        written to disk directly."""
+        sizes = {}
+        for name in LAYERS:
+            data = get_layer(world, name)
+            if data is not None:
+                sizes[name] = self._compact_nbytes(name, data)
+        resident = sum(sizes.values())
+        spilled = set()
+        for name in sorted(sizes, key=sizes.get, reverse=True):
+            if resident <= self.max_bytes:
+                break
+            if name not in active:
+                spilled.add(name)
+                resident -= sizes[name]
+
+        for name in LAYERS:
+            data = get_layer(world, name)
+            if data is None:
+                continue
+            # arrays are converted again when the float32 option changes
+            converted = isinstance(data, numpy.ndarray) and \
+                data.dtype == self._dtype(name, data)
+            if name in spilled:
+                if not converted or not isinstance(data, numpy.memmap):
+                    set_layer(world, name, self._spill(name, data))
+                    self._remove_spilled(data)
+            elif not converted or isinstance(data, numpy.memmap):
+                set_layer(world, name, self._load(name, data))
+                self._remove_spilled(data)
+            # release the previous version before converting the next one
+            del data
+
+    def _to_list(self, name, data):
+        if name == 'biome':
+            names = self.biome_names
+            return [[names[c] for c in row] for row in data.tolist()]
+        return data.tolist()
+
+    def restore(self, world, names=None):
+        """Convert back the given layers of world (all of them by default)
+        to lists of lists"""
+        for name in names if names is not None else LAYERS:
+            data = get_layer(world, name)
+            if not isinstance(data, numpy.ndarray):
+                continue
+            set_layer(world, name, self._to_list(name, data))
+            self._remove_spilled(data)
+            del data
+        if names is None:
+            self.cleanup()
+
+    def save(self, world, filename):
+        """Save world as protobuf without restoring its layers: the
+        serialization iterates on the rows, which are converted to lists one
+        at a time"""
+        compacted = {}
+        for name in LAYERS:
+            data = get_layer(world, name)
+            if isinstance(data, numpy.ndarray):
+                compacted[name] = data
+                set_layer(world, name, _ListRows(self, name, data))
+        try:
+            world.protobuf_to_file(filename)
+        finally:
+            for name, data in compacted.items():
+                set_layer(world, name, data)
+
+    def release(self, world):
+        """Delete the spilled layers of world, which is not used anymore"""
+        for name in LAYERS:
+            self._remove_spilled(get_layer(world, name))
+
+    def cleanup(self):
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+
+class _ListRows(object):
+    """Rows of a compacted layer, converted to lists when accessed"""
+
+    def __init__(self, budget, name, array):
+        self._budget = budget
+        self._name = name
+        self._array = array
+
+    def __len__(self):
+        return len(self._array)
+
+    def __getitem__(self, y):
+        return self._budget._to_list(self._name, self._array[y:y + 1])[0]
+
+    def __iter__(self):
+        for y in range(len(self._array)):
+            yield self[y]
@@ -0,0 +1,359 @@
+"""
+Local XYZ tile server for browsing a world in a web map viewer.
+
+Tiles are served as /{view}/{z}/{x}/{y}.png and are cut from the same
+renderers used by the GUI canvas. Spaces in view names can be written as
+dashes (e.g. /plates-and-elevation/0/0/0.png).
+"""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+import threading
+from PyQt5.QtCore import QBuffer, QByteArray, QIODevice, QRect, Qt
+from PyQt5.QtGui import QImage
+from worldengine.world import World
+from view import VIEWS, draw_view, is_view_applicable
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+
+
+TILE_SIZE = 256
+
+_TILE_PATH = re.compile(r'^/([^/]+)/(\d+)/(\d+)/(\d+)\.png$')
+
+# names of the files written by TileCache
+_TILE_FILE = re.compile(r'^[a-z-]+_\d+_\d+_\d+\.png$')
+
+
+def _view_from_url(name):
+    return unquote(name).replace('-', ' ')
+
+
+def _png_bytes(image):
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QIODevice.WriteOnly)
+    image.save(buf, 'PNG')
+    buf.close()
+    return data.data()
+
+
+def _etag(png):
+    return '"%s"' % hashlib.sha1(png).hexdigest()
+
+
+class TileCache(object):
+    """Two levels cache of encoded tiles: a LRU in memory and a directory
+    on disk, both evicting the least recently used tiles when full.
+
+    The directory should be specific to the world served: only the tiles
+    found in it are tracked (and evicted), other files are left alone.
+    """
+
+    def __init__(self, directory, max_memory_tiles=1024,
+                 max_disk_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_memory_tiles = max_memory_tiles
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = collections.OrderedDict()
+        self._disk = collections.OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            self._scan_disk()
+
+    def _scan_disk(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if _TILE_FILE.match(name) and os.path.isfile(path):
+                st = os.stat(path)
+                entries.append((st.st_atime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_bytes += size
+
+    @staticmethod
+    def _file_name(key):
+        view, z, x, y = key
+        return '%s_%i_%i_%i.png' % (view.replace(' ', '-'), z, x, y)
+
+    def get(self, key):
+        """Return (etag, png) or None"""
+        with self._lock:
+            if key in self._memory:
+                entry = self._memory.pop(key)
+                self._memory[key] = entry
+                return entry
+            name = self._file_name(key)
+            if name not in self._disk:
+                return None
+            self._disk[name] = self._disk.pop(name)
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                png = f.read()
+        except IOError:
+            with self._lock:
+                self._forget_file(name)
+            return None
+        entry = (_etag(png), png)
+        with self._lock:
+            self._remember(key, entry)
+        return entry
+
+    def put(self, key, png):
+        entry = (_etag(png), png)
+        with self._lock:
+            self._remember(key, entry)
+        if self.directory is None:
+            return entry
+        name = self._file_name(key)
+        tmp_path = os.path.join(self.directory, name + '.tmp')
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.rename(tmp_path, os.path.join(self.directory, name))
+        except (IOError, OSError):
+            # the tile is still served from memory
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return entry
+        with self._lock:
+            self._forget_file(name)
+            self._disk[name] = len(png)
+            self._disk_bytes += len(png)
+            self._evict_disk()
+        return entry
+
+    def _remember(self, key, entry):
+        self._memory.pop(key, None)
+        self._memory[key] = entry
+        while len(self._memory) > self.max_memory_tiles:
+            self._memory.popitem(last=False)
+
+    def _forget_file(self, name):
+        size = self._disk.pop(name, None)
+        if size is not None:
+            self._disk_bytes -= size
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            name, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class TileRenderer(object):
+    """Render tiles on demand, at most max_workers at the same time.
+
+    Each view is drawn once on a full size image by the view renderers,
+    tiles are then cut and scaled out of it. Concurrent requests for the
+    same tile wait for a single rendering.
+    """
+
+    def __init__(self, world, cache, max_workers=4):
+        self.world = world
+        self.cache = cache
+        self.extent = max(world.width, world.height)
+        self.max_zoom = 0
+        while (TILE_SIZE << self.max_zoom) < self.extent * 8:
+            self.max_zoom += 1
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._images = {}
+        self._image_locks = dict((v, threading.Lock()) for v in VIEWS)
+
+    def views(self):
+        return [v for v in VIEWS if is_view_applicable(self.world, v)]
+
+    def contains(self, view, z, x, y):
+        if view not in VIEWS or not is_view_applicable(self.world, view):
+            return False
+        if z > self.max_zoom:
+            return False
+        n = 1 << z
+        return x * self.extent < n * self.world.width and \
+            y * self.extent < n * self.world.height
+
+    def tile(self, view, z, x, y):
+        """Return (etag, png) of the given tile"""
+        key = (view, z, x, y)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry
+        with self._lock:
+            event = self._in_flight.get(key)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                self._in_flight[key] = event
+        if not owner:
+            event.wait()
+            entry = self.cache.get(key)
+            if entry is not None:
+                return entry
+            return self.tile(view, z, x, y)
+        try:
+            with self._slots:
+                png = _png_bytes(self._render(view, z, x, y))
+            return self.cache.put(key, png)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            event.set()
+
+    def _view_image(self, view):
+        with self._image_locks[view]:
+            if view not in self._images:
+                canvas = QImage(self.world.width, self.world.height,
+                                QImage.Format_RGB32)
+                draw_view(self.world, view, canvas)
+                self._images[view] = canvas.convertToFormat(
+                    QImage.Format_ARGB32)
+            return self._images[view]
+
+    def _render(self, view, z, x, y):
+        image = self._view_image(view)
+        n = 1 << z
+        x0 = x * self.extent // n
+        y0 = y * self.extent // n
+        x1 = max(x0 + 1, (x + 1) * self.extent // n)
+        y1 = max(y0 + 1, (y + 1) * self.extent // n)
+        # pixels outside the world are left transparent
+        region = image.copy(QRect(x0, y0, x1 - x0, y1 - y0))
+        return region.scaled(TILE_SIZE, TILE_SIZE, Qt.IgnoreAspectRatio,
+                             Qt.FastTransformation)
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        renderer = self.server.renderer
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            self._send_json({'name': renderer.world.name,
+                             'width': renderer.world.width,
+                             'height': renderer.world.height,
+                             'tile_size': TILE_SIZE,
+                             'max_zoom': renderer.max_zoom,
+                             'views': renderer.views()})
+            return
+        match = _TILE_PATH.match(path)
+        if match is None:
+            self.send_error(404)
+            return
+        view = _view_from_url(match.group(1))
+        z, x, y = [int(g) for g in match.groups()[1:]]
+        if not renderer.contains(view, z, x, y):
+            self.send_error(404)
+            return
+        etag, png = renderer.tile(view, z, x, y)
+        if etag in self._if_none_match():
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(png)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(png)
+
+    def _if_none_match(self):
+        header = self.headers.get('If-None-Match')
+        if header is None:
+            return []
+        return [t.strip() for t in header.split(',')]
+
+    def _send_json(self, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, renderer):
+        HTTPServer.__init__(self, address, TileRequestHandler)
+        self.renderer = renderer
+
+
+def _cache_dir(root, filename):
+    """Return the directory of the tiles of the world in root, identifying
+    the world by its path, size and modification time"""
+    if root is None:
+        root = os.path.join(os.path.expanduser('~'), '.cache',
+                            'worldengine-gui', 'tiles')
+    st = os.stat(filename)
+    world_id = hashlib.sha1(('%s:%i:%i' % (
+        os.path.abspath(filename), st.st_size, int(st.st_mtime))
+    ).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(root, world_id)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='worldengine-gui serve',
+        description='Serve the views of a world as XYZ tiles')
+    parser.add_argument('world', help='the .world file to serve')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on, use 0.0.0.0 to serve '
+                             'the local network')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='maximum number of tiles rendered at once')
+    parser.add_argument('--memory-tiles', type=int, default=1024,
+                        help='number of tiles kept in memory')
+    parser.add_argument('--disk-cache', default=None,
+                        help='directory of the on-disk tile cache, tiles '
+                             'are kept in a subdirectory for each world')
+    parser.add_argument('--disk-cache-mb', type=int, default=256)
+    parser.add_argument('--no-disk-cache', action='store_true')
+    args = parser.parse_args(argv)
+
+    world = World.open_protobuf(args.world)
+    cache_dir = None
+    if not args.no_disk_cache:
+        cache_dir = _cache_dir(args.disk_cache, args.world)
+    cache = TileCache(cache_dir, args.memory_tiles,
+                      args.disk_cache_mb * 1024 * 1024)
+    renderer = TileRenderer(world, cache, args.workers)
+    server = TileServer((args.host, args.port), renderer)
+    print("Serving %s on http://%s:%i/{view}/{z}/{x}/{y}.png" % (
+        args.world, args.host, args.port))
+    print("Views: %s" % ', '.join(renderer.views()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Time-lapse of the plates simulation.
+
+The heightmap is captured every few steps and stored in a single file:
+
+    header | frame | frame | ... | index | footer
+
+Heights are quantized to integers (multiples of the quantum written in the
+header) and each frame is stored as the difference from the previous one,
+except for key frames which are stored whole. Frames are byte-shuffled and
+compressed with zlib. The index at the end of the file holds the position,
+the simulation step and the range of heights of every frame, so that any
+frame can be decoded starting from the closest key frame before it.
+"""
+import struct
+import zlib
+import numpy
+
+
+_MAGIC = b'WETL'
+_INDEX_MAGIC = b'WETI'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHIIdII')
+_INDEX_ENTRY = struct.Struct('<QIIdd')
+_FOOTER = struct.Struct('<QI4s')
+
+
+class TimeLapseError(Exception):
+    """The file is not a complete time-lapse"""
+
+
+def _shuffle(values):
+    """Group the n-th bytes of all the values together: deltas are small so
+    most of the high bytes are equal and compress a lot better"""
+    return values.view(numpy.uint8).reshape(-1, 4).T.tobytes()
+
+
+def _unshuffle(data, count):
+    planes = numpy.frombuffer(data, dtype=numpy.uint8).reshape(4, count)
+    return planes.T.copy().view('<i4').reshape(count)
+
+
+class TimeLapseWriter(object):
+    """Record the heightmap every given number of steps"""
+
+    def __init__(self, filename, width, height, every=10, quantum=1.0 / 1024,
+                 keyframe_interval=32):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.every = every
+        self.quantum = quantum
+        self.keyframe_interval = keyframe_interval
+        self._index = []
+        self._previous = None
+        self.last_step = None
+        self._f = open(filename, 'wb')
+        self._f.write(_HEADER.pack(_MAGIC, _VERSION, width, height, quantum,
+                                   keyframe_interval, every))
+
+    def is_due(self, step):
+        return step % self.every == 0 and step != self.last_step
+
+    def capture(self, step, heightmap):
+        """Add a frame, heightmap is the flat list returned by platec"""
+        h = numpy.asarray(heightmap, dtype=numpy.float64)
+        q = numpy.rint(h / self.quantum).astype('<i4')
+        if len(self._index) % self.keyframe_interval == 0:
+            values = q
+        else:
+            values = q - self._previous
+        data = zlib.compress(_shuffle(values), 6)
+        self._index.append((self._f.tell(), len(data), step,
+                            float(h.min()), float(h.max())))
+        self._f.write(data)
+        self._previous = q
+        self.last_step = step
+
+    @property
+    def closed(self):
+        """True once the index has been written and the file closed"""
+        return self._f is None
+
+    def close(self):
+        if self._f is None:
+            return
+        try:
+            index_offset = self._f.tell()
+            for entry in self._index:
+                self._f.write(_INDEX_ENTRY.pack(*entry))
+            self._f.write(_FOOTER.pack(index_offset, len(self._index),
+                                       _INDEX_MAGIC))
+        finally:
+            self._f.close()
+            self._f = None
+
+
+class TimeLapseReader(object):
+
+    def __init__(self, filename):
+        self._f = open(filename, 'rb')
+        try:
+            self._read_index(filename)
+        except Exception:
+            self._f.close()
+            raise
+        self._cached = None
+
+    def _read(self, size):
+        data = self._f.read(size)
+        if len(data) != size:
+            raise TimeLapseError("%s is truncated" % self._f.name)
+        return data
+
+    def _read_index(self, filename):
+        header = self._f.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            raise TimeLapseError("%s is not a time-lapse file" % filename)
+        magic, version, self.width, self.height, self.quantum, \
+            self.keyframe_interval, self.every = _HEADER.unpack(header)
+        if magic != _MAGIC or version != _VERSION:
+            raise TimeLapseError("%s is not a time-lapse file" % filename)
+        self._f.seek(0, 2)
+        if self._f.tell() < _HEADER.size + _FOOTER.size:
+            raise TimeLapseError("Time-lapse %s was not completed" %
+                                 filename)
+        self._f.seek(-_FOOTER.size, 2)
+        index_offset, n_frames, magic = _FOOTER.unpack(
+            self._read(_FOOTER.size))
+        if magic != _INDEX_MAGIC:
+            raise TimeLapseError("Time-lapse %s was not completed" %
+                                 filename)
+        if n_frames == 0:
+            raise TimeLapseError("Time-lapse %s has no frames" % filename)
+        self._f.seek(index_offset)
+        data = self._read(n_frames * _INDEX_ENTRY.size)
+        self._index = [_INDEX_ENTRY.unpack_from(data, i * _INDEX_ENTRY.size)
+                       for i in range(n_frames)]
+
+    def __len__(self):
+        return len(self._index)
+
+    def step(self, i):
+        return self._index[i][2]
+
+    def elevation_range(self):
+        return min(e[3] for e in self._index), max(e[4] for e in self._index)
+
+    def _values(self, i):
+        offset, length, _, _, _ = self._index[i]
+        self._f.seek(offset)
+        data = zlib.decompress(self._f.read(length))
+        return _unshuffle(data, self.width * self.height)
+
+    def frame(self, i):
+        """Return the heightmap of the i-th frame as a height x width
+        array"""
+        if i < 0 or i >= len(self._index):
+            raise IndexError("No frame %i" % i)
+        key = i - i % self.keyframe_interval
+        if self._cached is not None and key <= self._cached[0] <= i:
+            j, q = self._cached
+        else:
+            j, q = key, self._values(key)
+        while j < i:
+            j += 1
+            q = q + self._values(j)
+        self._cached = (i, q)
+        return (q * self.quantum).reshape(self.height, self.width)
+
+    def close(self):
+        self._f.close()
+
+
+def to_grayscale(frame, min_el, max_el):
+    """Return the bytes of the frame as a 8 bits grayscale image"""
+    delta = (max_el - min_el) or 1.0
+    gray = numpy.clip((frame - min_el) * (255.0 / delta), 0, 255)
+    return gray.astype(numpy.uint8).tobytes()
@@ -1,6 +1,8 @@
 from PyQt5 import QtGui
 import math
 from worldengine.draw import elevation_color
+from views.PrecipitationsView import PrecipitationsView
+from views.WatermapView import WatermapView
 
 
 def draw_simple_elevation_on_screen(world, canvas):
@@ -71,10 +73,11 @@ def hsi_to_rgb(hue, saturation, intensity):
 def draw_plates_on_screen(world, canvas):
     width = world.width
     height = world.height
-    n_plates = world.n_actual_plates()
+    # plates can be small numpy integers with a memory budget
+    n_plates = int(world.n_actual_plates())
     for y in range(0, height):
         for x in range(0, width):
-            h = world.plates[y][x] * (360 / n_plates)
+            h = int(world.plates[y][x]) * (360 / n_plates)
             s = 0.5
             i = 64.0
             r, g, b = hsi_to_rgb(h, s, i)
@@ -85,13 +88,14 @@ def draw_plates_on_screen(world, canvas):
 def draw_plates_and_elevation_on_screen(world, canvas):
     width = world.width
     height = world.height
-    n_plates = world.n_actual_plates()
+    # plates can be small numpy integers with a memory budget
+    n_plates = int(world.n_actual_plates())
     max_el = world.max_elevation()
     min_el = world.min_elevation()
     delta_el = max_el - min_el
     for y in range(0, height):
         for x in range(0, width):
-            h = world.plates[y][x] * (360 / n_plates)
+            h = int(world.plates[y][x]) * (360 / n_plates)
             el = world.elevation['data'][y][x]
             s = 0.6
             i = 40.0 + 60.0 * ((el - min_el) / delta_el)
@@ -111,3 +115,43 @@ def draw_land_on_screen(world, canvas):
                 canvas.setPixel(x, y, land_color)
             else:
                 canvas.setPixel(x, y, ocean_color)
+
+
+VIEWS = ['bw', 'plates', 'plates and elevation', 'land', 'precipitations',
+         'watermap']
+
+# layers read by each view
+VIEW_LAYERS = {
+    'bw': ['elevation'],
+    'plates': ['plates'],
+    'plates and elevation': ['plates', 'elevation'],
+    'land': ['ocean'],
+    'precipitations': ['precipitation', 'ocean'],
+    'watermap': ['watermap', 'ocean']
+}
+
+
+def is_view_applicable(world, view):
+    if view == 'precipitations':
+        return PrecipitationsView().is_applicable(world)
+    elif view == 'watermap':
+        return WatermapView().is_applicable(world)
+    else:
+        return view in VIEWS
+
+
+def draw_view(world, view, canvas):
+    if view == 'bw':
+        draw_bw_elevation_on_screen(world, canvas)
+    elif view == 'plates':
+        draw_plates_on_screen(world, canvas)
+    elif view == 'plates and elevation':
+        draw_plates_and_elevation_on_screen(world, canvas)
+    elif view == 'land':
+        draw_land_on_screen(world, canvas)
+    elif view == 'precipitations':
+        PrecipitationsView().draw(world, canvas)
+    elif view == 'watermap':
+        WatermapView().draw(world, canvas)
+    else:
+        raise Exception("Unknown view %s" % view)